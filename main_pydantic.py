@@ -1,10 +1,30 @@
-from fastapi import FastAPI, Path, HTTPException, Query
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field, computed_field
+from fastapi import FastAPI, Path, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, Field, TypeAdapter, computed_field
 from typing import Annotated, Literal, Optional
-import json
+from bisect import bisect_right
+from contextlib import asynccontextmanager, closing
+import asyncio
+import numpy as np
+import orjson
+import os
+import sqlite3
+import tempfile
 import uvicorn
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # stop_write_flusher is defined with the write queue further down
+    await stop_write_flusher()
+
+app = FastAPI(lifespan=lifespan)
+
+def json_response(content, status_code=200, headers=None):
+    # encode with orjson here, fastapi's ORJSONResponse is deprecated
+    return Response(content=orjson.dumps(content), status_code=status_code, headers=headers, media_type="application/json")
+# /view returns every record, compress bodies big enough to be worth it
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
 class Patient(BaseModel):
     id: Annotated[str, Field(..., description="The ID of the patient", example="P001")]
@@ -18,90 +38,363 @@ class Patient(BaseModel):
     @computed_field
     @property
     def bmi(self) -> float:
-        return self.weight / (self.height ** 2)
+        return self.weight / (self.height * self.height)
 
     # computed field will call the computed field again
     # so first verdict triggered using using self.bmi than bmi triggered  
     @computed_field
     @property
     def verdict(self) -> str:
-        if self.bmi < 18.5:
-            return "Underweight"
-        elif self.bmi >= 18.5 and self.bmi < 25:
-            return "Normal"
-        elif self.bmi >= 25 and self.bmi < 30:
-            return "Overweight"
-        else:
-            return "Obese"
+        return bmi_verdict(self.bmi)
+
+# validates a whole list of patients in one pass through pydantic-core
+PATIENT_LIST_ADAPTER = TypeAdapter(list[Patient])
+
+DATA_PATH = "pateints.json"
+DB_PATH = "pateints.db"
+
+# columns returned for a pateint record (id is the key, not part of the record)
+RECORD_COLUMNS = ("name", "city", "age", "gender", "height", "weight", "bmi")
+
+SORT_FIELDS = ('height', 'weight', 'bmi')
+VALID_SORT_FIELDS = frozenset(SORT_FIELDS)
+# valid values of the order query param, mapped to whether it sorts descending
+SORT_DESCENDING = {'asc': False, 'desc': True}
+
+# bmi is a stored generated column so it is always in step with height and weight
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    city TEXT NOT NULL,
+    age INTEGER NOT NULL,
+    gender TEXT NOT NULL,
+    height REAL NOT NULL,
+    weight REAL NOT NULL,
+    bmi REAL GENERATED ALWAYS AS (weight / (height * height)) STORED
+);
+"""
+
+# a bmi below BMI_THRESHOLDS[i] gets BMI_VERDICTS[i], anything above the last one is Obese
+BMI_THRESHOLDS = (18.5, 25.0, 30.0)
+BMI_VERDICTS = ("Underweight", "Normal", "Overweight", "Obese")
+
+def bmi_verdict(bmi):
+    return BMI_VERDICTS[bisect_right(BMI_THRESHOLDS, bmi)]
+
+def connect(path=DB_PATH):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def row_to_record(row, verdict=None):
+    record = {column: row[column] for column in RECORD_COLUMNS}
+    record["verdict"] = bmi_verdict(record["bmi"]) if verdict is None else verdict
+    return record
+
+def rows_to_columns(rows):
+    # one contiguous array per sortable field, in the same order as rows
+    return {field: np.fromiter((row[field] for row in rows), dtype=np.float64, count=len(rows)) for field in SORT_FIELDS}
+
+def bulk_verdicts(bmis):
+    # same buckets as bmi_verdict, worked out for every row in one searchsorted pass
+    categories = np.searchsorted(BMI_THRESHOLDS, bmis, side="right")
+    return [BMI_VERDICTS[category] for category in categories.tolist()]
+
+def fetch_all_rows():
+    with closing(connect()) as conn:
+        return conn.execute("SELECT id, %s FROM patients" % ", ".join(RECORD_COLUMNS)).fetchall()
+
+def fetch_row(pateint_id):
+    with closing(connect()) as conn:
+        return conn.execute("SELECT id, %s FROM patients WHERE id = ?" % ", ".join(RECORD_COLUMNS), (pateint_id,)).fetchone()
+
+# write helpers take the connection of the batch they are applied in, see submit_write
+def insert_row(conn, values):
+    conn.execute("INSERT INTO patients (id, name, city, age, gender, height, weight) VALUES (?, ?, ?, ?, ?, ?, ?)", values)
+
+def update_row(conn, pateint_id, changes):
+    # only the changed columns are set, so edits to different fields of the same
+    # pateint never overwrite each other, the keys are PateintUpdate field names
+    # so they are safe to put in the query
+    assignments = ", ".join("%s = ?" % column for column in changes)
+    return conn.execute(
+        "UPDATE patients SET %s WHERE id = ?" % assignments, (*changes.values(), pateint_id)
+    ).rowcount
+
+def delete_row(conn, pateint_id):
+    return conn.execute("DELETE FROM patients WHERE id = ?", (pateint_id,)).rowcount
+
+def apply_writes(writes):
+    # one transaction (and one fsync) for the whole batch, each write gets a
+    # savepoint so a failing one is rolled back without losing the others
+    results = []
+    with closing(connect()) as conn:
+        conn.isolation_level = None
+        conn.execute("BEGIN")
+        try:
+            for write, args in writes:
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append(write(conn, *args))
+                except sqlite3.Error as e:
+                    conn.execute("ROLLBACK TO write")
+                    results.append(e)
+                conn.execute("RELEASE write")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return results
+
+def init_db():
+    if os.path.exists(DB_PATH):
+        with closing(connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+        return
+    # one time migration: the first start copies pateints.json into sqlite
+    # each process builds its own copy under a unique temporary name and then
+    # publishes it with os.link, which fails if the database already exists, so
+    # workers starting together never touch a file another one is still filling
+    # and a crash half way through leaves no half filled database behind
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(DB_PATH) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(DB_PATH)))
+    os.close(fd)
+    try:
+        # mkstemp creates the file as 0600, give it the mode a plain open() would
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        with closing(connect(tmp_path)) as conn, conn:
+            conn.executescript(SCHEMA)
+            if os.path.exists(DATA_PATH):
+                with open(DATA_PATH, "rb") as f:
+                    data = orjson.loads(f.read())
+                # validate every seed record against Patient in a single call
+                patients = PATIENT_LIST_ADAPTER.validate_python(
+                    [{**p, "id": pateint_id, "gender": p["gender"].lower()} for pateint_id, p in data.items()]
+                )
+                conn.executemany(
+                    "INSERT INTO patients (id, name, city, age, gender, height, weight) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(p.id, p.name, p.city, p.age, p.gender, p.height, p.weight) for p in patients],
+                )
+        try:
+            os.link(tmp_path, DB_PATH)
+        except FileExistsError:
+            # another worker finished the migration first, its copy is kept
+            pass
+        except OSError:
+            # no hard links on this filesystem (vfat, smb, some bind mounts), so
+            # rename instead; that can only replace a copy another worker published
+            # in the instant since the check, and every copy holds the same seed
+            if not os.path.exists(DB_PATH):
+                os.replace(tmp_path, DB_PATH)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+init_db()
+
+def db_version():
+    # the file's mtime plus sqlite's file change counter (header bytes 24-27),
+    # which every commit bumps, so two commits inside one mtime tick still differ
+    with open(DB_PATH, "rb") as f:
+        header = f.read(28)
+        return (os.fstat(f.fileno()).st_mtime_ns, int.from_bytes(header[24:28], "big"))
+
+# every record keyed by id, reused until db_version() changes
+# ids, records and columns hold the same rows in a fixed order for /sort, and
+# sorted keeps the encoded /sort body for each (sort_by, order) already asked for
+# generation is bumped by invalidate_cache so a reload that overlapped a write
+# does not store the rows it read before that write
+_CACHE = {"version": None, "generation": 0, "data": None, "ids": None, "records": None, "columns": None, "sorted": {}}
 
-def load_data():
-    with open("pateints.json", "r") as f:
-        data = json.load(f) 
+# only one reload runs at a time, requests arriving meanwhile wait for it and
+# then find the cache current instead of fetching the whole table again
+_RELOAD_LOCK = asyncio.Lock()
+
+# sqlite calls block, so they run in the threadpool to keep the event loop free
+async def load_data():
+    version = db_version()
+    if version == _CACHE["version"]:
+        return _CACHE["data"]
+    async with _RELOAD_LOCK:
+        version = db_version()
+        if version == _CACHE["version"]:
+            return _CACHE["data"]
+        return await reload_data(version)
+
+async def reload_data(version):
+    generation = _CACHE["generation"]
+    rows = await run_in_threadpool(fetch_all_rows)
+    columns = rows_to_columns(rows)
+    records = [row_to_record(row, verdict) for row, verdict in zip(rows, bulk_verdicts(columns["bmi"]))]
+    data = {row["id"]: record for row, record in zip(rows, records)}
+    if generation != _CACHE["generation"]:
+        # a write was committed while the rows were being read, so they may be
+        # stale, hand them to this request but leave the cache empty
+        return data
+    _CACHE["version"] = version
+    _CACHE["data"] = data
+    _CACHE["ids"] = [row["id"] for row in rows]
+    _CACHE["records"] = records
+    _CACHE["columns"] = columns
+    _CACHE["sorted"] = {}
     return data
 
-def save_data(data):
-    with open("pateints.json", "w") as f:
-        json.dump(data, f)
-# save the data to the file
+def cached_data():
+    # the cached records if they still match the database file, without reloading
+    if _CACHE["data"] is not None and db_version() == _CACHE["version"]:
+        return _CACHE["data"]
+    return None
+
+async def load_columns():
+    await load_data()
+    return _CACHE["ids"], _CACHE["records"], _CACHE["columns"], _CACHE["sorted"]
+
+def invalidate_cache():
+    # drop the cache explicitly rather than wait for db_version() to move
+    _CACHE["version"] = None
+    _CACHE["generation"] += 1
+    _CACHE["data"] = None
+    _CACHE["ids"] = None
+    _CACHE["records"] = None
+    _CACHE["columns"] = None
+    _CACHE["sorted"] = {}
+
+# state of the background task that commits queued writes (group commit): an
+# idle writer commits a write straight away, and whatever queues up while a
+# commit is running goes out together in the next one
+_WRITER = {"task": None, "wakeup": None, "pending": [], "stopping": False}
+
+async def flush_writes():
+    batch = _WRITER["pending"]
+    _WRITER["pending"] = []
+    if not batch:
+        return
+    try:
+        results = await run_in_threadpool(apply_writes, [(write, args) for write, args, _ in batch])
+    except Exception as e:
+        results = [e] * len(batch)
+    invalidate_cache()
+    for (_, _, future), result in zip(batch, results):
+        if future.done():
+            continue
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+async def write_flusher():
+    wakeup = _WRITER["wakeup"]
+    while True:
+        await wakeup.wait()
+        wakeup.clear()
+        await flush_writes()
+        if _WRITER["stopping"] and not _WRITER["pending"]:
+            return
+
+async def submit_write(write, *args):
+    # queue the write for the next batch and wait until it is committed, so a
+    # response is only sent once the change is on disk
+    loop = asyncio.get_running_loop()
+    task = _WRITER["task"]
+    if task is None or task.done() or task.get_loop() is not loop:
+        _WRITER["wakeup"] = asyncio.Event()
+        _WRITER["task"] = loop.create_task(write_flusher())
+    future = loop.create_future()
+    _WRITER["pending"].append((write, args, future))
+    _WRITER["wakeup"].set()
+    return await future
+
+async def stop_write_flusher():
+    # let the flusher commit whatever is still queued before the server exits
+    task = _WRITER["task"]
+    if task is not None and not task.done():
+        _WRITER["stopping"] = True
+        _WRITER["wakeup"].set()
+        await task
+    _WRITER["task"] = None
+    _WRITER["stopping"] = False
+
+# these never change, so the responses are built once and sent as they are
+HELLO_RESPONSE = json_response({"message": "pateint management system"}, headers={"Cache-Control": "public, max-age=3600"})
+ABOUT_RESPONSE = json_response({"message": "A full stack pateint records"}, headers={"Cache-Control": "public, max-age=3600"})
+
 @app.get("/")
-def hello(): # decorator function
-    return {"message": "pateint management system"}
+async def hello(): # decorator function
+    return HELLO_RESPONSE
 
 
 @app.get("/about")
-def about():
+async def about():
     
-    return {"message": "A full stack pateint records"}
+    return ABOUT_RESPONSE
 
 @app.get('/view')
-def view():
-    data = load_data()
-    return data
+async def view(request: Request):
+    # the etag changes with every commit, read it before loading so the etag
+    # is never newer than the data sent with it
+    etag = 'W/"%d-%d"' % db_version()
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+    data = await load_data()
+    return json_response(data, headers={"ETag": etag, "Cache-Control": "private, max-age=1"})
 
 @app.get('/pateint/{pateint_id}')
-def view_pateint(pateint_id: str = Path(..., description="The ID of the pateint to view", example="P001")):
+async def view_pateint(pateint_id: str = Path(..., description="The ID of the pateint to view", example="P001")):
     # three dots meaning is reqired
-    data = load_data()
+    # answer from the cache when it is current, otherwise look up just this row
+    data = cached_data()
+    if data is not None:
+        record = data.get(pateint_id)
+    else:
+        row = await run_in_threadpool(fetch_row, pateint_id)
+        record = None if row is None else row_to_record(row)
 
-    if pateint_id not in data:
+    if record is None:
         raise HTTPException(status_code=404, detail="Pateint not found")
     else:
-        return data[pateint_id]
+        # encode the record ourselves, it came from the database so there is nothing to validate
+        return json_response(record)
 @app.get('/sort')
-def sort(sort_by: str = Query(..., description="sort on the basis of height, weight,  or bmi", example="170cm"),
+async def sort(sort_by: str = Query(..., description="sort on the basis of height, weight,  or bmi", example="170cm"),
     order: str = Query('asc',)):
 
-    valid_fields = ['height', 'weight', 'bmi']
-    if sort_by not in valid_fields:
-        raise HTTPException(status_code=400, detail=f"Invalid sort field select from {valid_fields}")
-    if order not in ['asc', 'desc']:
+    if sort_by not in VALID_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Invalid sort field select from {list(SORT_FIELDS)}")
+    if order not in SORT_DESCENDING:
         raise HTTPException(status_code=400, detail="Invalid order")
 
-    data = load_data()
-    sort_order = -1 if order == 'desc' else 1
-    sorted_data = sorted(data.values(), key=lambda x: x[sort_by], reverse=sort_order)
-    return data
+    ids, records, columns, sorted_bodies = await load_columns()
+    body = sorted_bodies.get((sort_by, order))
+    if body is None:
+        # descending sorts the negated key so ties keep the same order as asc
+        keys = columns[sort_by]
+        idx = np.argsort(-keys if SORT_DESCENDING[order] else keys, kind="stable")
+        # the list drops the dict keys, so each entry carries its id
+        body = orjson.dumps([{"id": ids[i], **records[i]} for i in idx])
+        sorted_bodies[(sort_by, order)] = body
+    return Response(content=body, media_type="application/json")
 
 @app.post('/create')
-def create_pateint(pateint: Patient):# pydantic will check here for dta validation
+async def create_pateint(pateint: Patient):# pydantic will check here for dta validation
     # as pateint is here is pydantic object
     # and data is in dictionary format
     # we will combine both for the validation
-    #load the existing data
-    data = load_data()
-    # check if the pateint already exists
-    if pateint.id in data:
+    # new pateint data will be added to the table
+    # using checking the pydantic object to use validation
+    # it applied all the checks and then add the data to the table
+    # the primary key rejects a pateint that already exists
+    try:
+        await submit_write(
+            insert_row,
+            (pateint.id, pateint.name, pateint.city, pateint.age, pateint.gender, pateint.height, pateint.weight),
+        )
+    except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Pateint already exists")
- 
- # new pateint data will be added to the data
- # using checking the pydantic object to use validation
- # it applied all the checks and then add the data to the data
-    data[pateint.id] = pateint.model_dump()
-    
-
-# now we have to save the data
-    save_data(data)
-    return JSONResponse(content={"message": "Pateint created successfully"}, status_code=201)
+    return json_response({"message": "Pateint created successfully"}, status_code=201)
 
 
 
@@ -114,44 +407,56 @@ class PateintUpdate(BaseModel):
     height: Annotated[Optional[float], Field(default=None, gt=0, lt=2.5, description="The height of the patient in cm", example=1.75)]
     weight: Annotated[Optional[float], Field(default=None, gt=0, description="The weight of the patient in kg", example=70.0)]
 
+# pydantic-core serializer for PateintUpdate, skips the model_dump wrapper on every edit
+_update_serializer = PateintUpdate.__pydantic_serializer__
+
 @app.put('/edit/{pateint_id}')
-def update_pateint(pateint_id: str, pateint_update: PateintUpdate):
-    data = load_data()
-    if pateint_id not in data:
+async def update_pateint(pateint_id: str, pateint_update: PateintUpdate):
+    data = cached_data()
+    if data is not None and pateint_id not in data:
         raise HTTPException(status_code=404, detail="Pateint not found")
-    existing_pateint_info = data[pateint_id].copy()
         
-    updated_pateint_info = pateint_update.model_dump(exclude_unset=True)
-
-    for key, value in updated_pateint_info.items():
-        if value is not None:
-            existing_pateint_info[key] = value
+    updated_pateint_info = _update_serializer.to_python(pateint_update, exclude_unset=True)
+    changes = {key: value for key, value in updated_pateint_info.items() if value is not None}
     
     # Normalize gender to lowercase to match Patient model expectations
-    if 'gender' in existing_pateint_info:
-        gender = existing_pateint_info['gender']
-        if isinstance(gender, str):
-            existing_pateint_info['gender'] = gender.lower()
+    if 'gender' in changes:
+        changes['gender'] = changes['gender'].lower()
     
-    # existing_pateint_info -> pydantic object -> updated bmi + verdict -> pydantic object -> dict
-    existing_pateint_info['id'] = pateint_id
-    pateint_pydantic_object = Patient(**existing_pateint_info)
-    existing_pateint_info = pateint_pydantic_object.model_dump(exclude='id')
-    data[pateint_id] = existing_pateint_info
-    save_data(data)
-    return JSONResponse(content={"message": "Pateint updated successfully"}, status_code=200)
+    # the changed fields were already validated by PateintUpdate, so write them
+    # directly, sqlite recomputes bmi and verdict is derived on read
+    if changes:
+        updated = await submit_write(update_row, pateint_id, changes)
+    elif data is not None:
+        updated = 1
+    else:
+        updated = 0 if await run_in_threadpool(fetch_row, pateint_id) is None else 1
+    if updated == 0:
+        # the pateint is gone, e.g. deleted while this edit was queued
+        raise HTTPException(status_code=404, detail="Pateint not found")
+    return json_response({"message": "Pateint updated successfully"}, status_code=200)
 
 @app.delete('/delete/{pateint_id}')
-def delete_pateint(pateint_id: str):
-    data = load_data()
-    if pateint_id not in data:
+async def delete_pateint(pateint_id: str):
+    # an unknown id can be turned away from the cache without queueing a write
+    data = cached_data()
+    if data is not None and pateint_id not in data:
+        raise HTTPException(status_code=404, detail="Pateint not found")
+    deleted = await submit_write(delete_row, pateint_id)
+    if deleted == 0:
         raise HTTPException(status_code=404, detail="Pateint not found")
     else:
-        del data[pateint_id]
-        save_data(data)
-        return JSONResponse(content={"message": "Pateint deleted successfully"}, status_code=200)
+        return json_response({"message": "Pateint deleted successfully"}, status_code=200)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
-
-
+    # workers need the app as an import string, WEB_CONCURRENCY overrides the default count
+    # "auto" picks uvloop and httptools when they are installed (uvicorn[standard]
+    # skips uvloop on windows) and falls back to asyncio and h11 otherwise
+    uvicorn.run(
+        "main_pydantic:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() * 2 + 1)),
+    )
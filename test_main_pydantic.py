@@ -0,0 +1,107 @@
+import asyncio
+import importlib
+import os
+import shutil
+import sys
+import time
+
+import httpx
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    # run against a fresh copy of the seed data, main_pydantic migrates it on import
+    shutil.copy(os.path.join(REPO_DIR, "pateints.json"), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    if "main_pydantic" in sys.modules:
+        return importlib.reload(sys.modules["main_pydantic"])
+    return importlib.import_module("main_pydantic")
+
+
+def run(m, scenario):
+    async def main():
+        transport = httpx.ASGITransport(app=m.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            try:
+                return await scenario(client)
+            finally:
+                await m.stop_write_flusher()
+    return asyncio.run(main())
+
+
+def new_pateint(pateint_id):
+    return {"id": pateint_id, "name": "Test", "city": "Pune", "age": 30, "gender": "male", "height": 1.8, "weight": 70.0}
+
+
+def test_concurrent_edits_to_different_fields_both_apply(app_module):
+    async def scenario(client):
+        responses = await asyncio.gather(
+            client.put("/edit/P002", json={"age": 50}),
+            client.put("/edit/P002", json={"city": "Delhi"}),
+        )
+        return [r.status_code for r in responses], (await client.get("/pateint/P002")).json()
+
+    statuses, pateint = run(app_module, scenario)
+    assert statuses == [200, 200]
+    assert pateint["age"] == 50
+    assert pateint["city"] == "Delhi"
+
+
+def test_duplicate_create_in_the_same_batch(app_module, monkeypatch):
+    batches = []
+    apply_writes = app_module.apply_writes
+
+    def slow_apply_writes(writes):
+        batches.append(len(writes))
+        if len(batches) == 1:
+            # hold the first commit so the next writes queue up behind it
+            time.sleep(0.1)
+        return apply_writes(writes)
+
+    monkeypatch.setattr(app_module, "apply_writes", slow_apply_writes)
+
+    async def scenario(client):
+        first = asyncio.create_task(client.post("/create", json=new_pateint("T001")))
+        while not batches:
+            await asyncio.sleep(0.001)
+        duplicates = await asyncio.gather(
+            client.post("/create", json=new_pateint("T002")),
+            client.post("/create", json=new_pateint("T002")),
+        )
+        return (await first).status_code, sorted(r.status_code for r in duplicates), (await client.get("/view")).json()
+
+    first, duplicates, data = run(app_module, scenario)
+    assert batches == [1, 2]
+    assert first == 201
+    assert duplicates == [201, 400]
+    assert "T001" in data and "T002" in data
+
+
+def test_edit_racing_a_delete_returns_404(app_module):
+    async def scenario(client):
+        # warm the cache so the edit gets past the cached existence check
+        await client.get("/view")
+        responses = await asyncio.gather(
+            client.delete("/delete/P003"),
+            client.put("/edit/P003", json={"age": 40}),
+        )
+        return [r.status_code for r in responses], (await client.get("/pateint/P003")).status_code
+
+    statuses, lookup = run(app_module, scenario)
+    assert statuses == [200, 404]
+    assert lookup == 404
+
+
+def test_writer_restarts_on_a_new_event_loop(app_module):
+    run(app_module, lambda client: client.post("/create", json=new_pateint("T003")))
+
+    async def scenario(client):
+        created = await client.post("/create", json=new_pateint("T004"))
+        return created.status_code, (await client.get("/view")).json()
+
+    status, data = run(app_module, scenario)
+    assert status == 201
+    assert "T003" in data and "T004" in data